@@ -19,12 +19,12 @@ def check_tiff(filepath):
     print(f"Driver: {ds.GetDriver().ShortName}/{ds.GetDriver().LongName}")
     print(f"Size: {ds.RasterXSize} x {ds.RasterYSize} x {ds.RasterCount}")
     
-    # Check each band
-    for i in range(1, ds.RasterCount + 1):
-        band = ds.GetRasterBand(i)
-        print(f"\nBand {i}:")
-        print(f"  Data Type: {gdal.GetDataTypeName(band.DataType)}")
-        print(f"  Block Size: {band.GetBlockSize()}")
+    # Check each band, fetching all band info in a single GDAL call
+    info = gdal.Info(ds, format='json', deserialize=True)
+    for band in info['bands']:
+        print(f"\nBand {band['band']}:")
+        print(f"  Data Type: {band['type']}")
+        print(f"  Block Size: {band['block']}")
         
     # Get metadata and check for compression info
     metadata = ds.GetMetadata("IMAGE_STRUCTURE")
@@ -1,15 +1,38 @@
 #!/usr/bin/env python3
 """
 Fix TIFF files with predictor compression issues for 64-bit samples.
-This script recompresses TIFFs without the predictor to make them GDAL-compatible.
+This script recompresses TIFFs without the predictor to make them GDAL-compatible,
+writing Cloud Optimized GeoTIFFs with internal overviews.
 """
 
+import fnmatch
 import os
+import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from osgeo import gdal
 import argparse
 
-def fix_tiff_predictor(input_file, output_file=None, compression='DEFLATE'):
+# Total GDAL block cache budget (MB), shared across directory-mode workers
+GDAL_CACHE_MB = 2048
+
+def configure_gdal(cache_mb=GDAL_CACHE_MB):
+    """Set GDAL options for the CLI and for each directory-mode worker."""
+    gdal.UseExceptions()
+    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'TRUE')
+    gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+    # Larger block cache avoids re-decompressing tiles while building overviews;
+    # a GDAL_CACHEMAX set in the environment takes precedence
+    if 'GDAL_CACHEMAX' not in os.environ:
+        gdal.SetConfigOption('GDAL_CACHEMAX', str(cache_mb))
+    # Let uncompressed source reads bypass libtiff's internal copy
+    gdal.SetConfigOption('GTIFF_DIRECT_IO', 'YES')
+    gdal.SetConfigOption('GTIFF_VIRTUAL_MEM_IO', 'IF_ENOUGH_RAM')
+    gdal.SetConfigOption('VSI_CACHE', 'TRUE')
+    gdal.SetConfigOption('VSI_CACHE_SIZE', str(64 * 1024 * 1024))
+
+def fix_tiff_predictor(input_file, output_file=None, compression='ZSTD', verify=False,
+                       progress=True):
     """
     Recompress a TIFF file without predictor to fix GDAL compatibility issues.
     
@@ -17,13 +40,17 @@ def fix_tiff_predictor(input_file, output_file=None, compression='DEFLATE'):
         input_file: Path to input TIFF with predictor issues
         output_file: Path for output TIFF (if None, adds '_fixed' suffix)
         compression: Compression type (NONE, LZW, DEFLATE, ZSTD)
+        verify: Decode the first block of the output to check it is readable
+        progress: Print per-file status and GDAL's progress bar (off for
+            directory-mode workers, whose parent reports progress instead)
     """
     if output_file is None:
         base, ext = os.path.splitext(input_file)
         output_file = f"{base}_fixed{ext}"
     
-    print(f"Processing: {input_file}")
-    print(f"Output: {output_file}")
+    if progress:
+        print(f"Processing: {input_file}")
+        print(f"Output: {output_file}")
     
     # Open source dataset
     src_ds = gdal.Open(input_file)
@@ -31,31 +58,49 @@ def fix_tiff_predictor(input_file, output_file=None, compression='DEFLATE'):
         print(f"Error: Could not open {input_file}")
         return False
     
-    # Create output with specific creation options
-    driver = gdal.GetDriverByName('GTiff')
+    # Skip re-encoding when the input already matches the target layout
+    structure = src_ds.GetMetadata("IMAGE_STRUCTURE") or {}
+    current_compression = structure.get('COMPRESSION', 'NONE').upper()
+    predictor = structure.get('PREDICTOR', '1')
+    layout = structure.get('LAYOUT', '').upper()
+    block_size = src_ds.GetRasterBand(1).GetBlockSize()
+    if (layout == 'COG' and current_compression == compression
+            and predictor == '1' and block_size == [512, 512]):
+        src_ds = None
+        shutil.copyfile(input_file, output_file)
+        if progress:
+            print(f"Already compliant, copied to: {output_file}")
+        return True
+    
+    # Create output with the COG driver, which encodes tiles on multiple threads
+    driver = gdal.GetDriverByName('COG')
     
     # Creation options to avoid predictor with 64-bit data
     creation_options = [
         f'COMPRESS={compression}',
-        'PREDICTOR=1',  # Explicitly set to NONE (1) instead of horizontal differencing (2)
-        'TILED=YES',
-        'BLOCKXSIZE=512',
-        'BLOCKYSIZE=512',
-        'BIGTIFF=YES'  # Use BigTIFF for large files
+        'PREDICTOR=NO',  # No predictor instead of horizontal differencing
+        'BLOCKSIZE=512',  # COG tiles are always 512x512 internal blocks
+        'BIGTIFF=YES',  # Use BigTIFF for large files
+        'OVERVIEWS=AUTO',  # Build internal overviews for tile servers
+        f'OVERVIEW_COMPRESS={compression}',
+        'NUM_THREADS=ALL_CPUS'  # Compress tiles in parallel
     ]
     
     # Additional options for better compatibility
     if compression == 'DEFLATE':
-        creation_options.append('ZLEVEL=6')
+        creation_options.append('LEVEL=6')
+    elif compression == 'ZSTD':
+        creation_options.append('LEVEL=9')
     
-    print(f"Creation options: {creation_options}")
+    if progress:
+        print(f"Creation options: {creation_options}")
     
     # Create output dataset
     out_ds = driver.CreateCopy(
         output_file,
         src_ds,
         options=creation_options,
-        callback=gdal.TermProgress_nocb
+        callback=gdal.TermProgress_nocb if progress else None
     )
     
     if not out_ds:
@@ -66,42 +111,111 @@ def fix_tiff_predictor(input_file, output_file=None, compression='DEFLATE'):
     # Flush cache
     out_ds.FlushCache()
     
+    # Verify the output can be read. The COG driver returns the written file
+    # reopened, so check it here instead of opening it a second time
+    ok = True
+    if verify:
+        try:
+            # Decode a single block to verify it works
+            gdal.ErrorReset()
+            out_ds.GetRasterBand(1).ReadBlock(0, 0)
+            ok = gdal.GetLastErrorType() < gdal.CE_Failure
+        except Exception as e:
+            print(f"Warning: Output file created but may still have issues: {e}")
+            ok = False
+    
     # Clean up
     src_ds = None
     out_ds = None
     
-    print(f"Successfully created: {output_file}")
-    
-    # Verify the output can be read
-    test_ds = gdal.Open(output_file)
-    if test_ds:
-        band = test_ds.GetRasterBand(1)
-        try:
-            # Try to read a small portion to verify it works
-            data = band.ReadAsArray(0, 0, min(100, band.XSize), min(100, band.YSize))
-            print("Verification: Output file is readable")
-            test_ds = None
-            return True
-        except Exception as e:
-            print(f"Warning: Output file created but may still have issues: {e}")
-            test_ds = None
-            return False
-    else:
+    if progress:
+        print(f"Successfully created: {output_file}")
+    if verify and ok and progress:
+        print("Verification: Output file is readable")
+    elif verify:
         print("Error: Could not verify output file")
-        return False
+    return ok
+
+def is_path_pattern(pattern):
+    """Return True if pattern has a directory part (e.g. '2020*/*.tif')."""
+    return os.sep in pattern or bool(os.altsep and os.altsep in pattern)
 
-def process_directory(directory, pattern="*.tif", compression='DEFLATE'):
+def iter_tiff_files(directory, pattern="*.tif"):
+    """
+    Lazily yield files in a directory whose names match pattern.
+    
+    Matches like glob.glob: names starting with '.' (e.g. macOS '._*'
+    AppleDouble files) are skipped unless the pattern also starts with '.'.
+    Only file name patterns are supported, not patterns with a directory part.
+    """
+    if is_path_pattern(pattern):
+        raise ValueError(f"Pattern must be a file name pattern, not a path: {pattern}")
+    include_hidden = pattern.startswith('.')
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') and not include_hidden:
+                continue
+            if entry.is_file() and fnmatch.fnmatch(entry.name, pattern):
+                yield entry.path
+
+def get_worker_count():
+    """
+    Number of directory-mode worker processes.
+    
+    Every worker already compresses with NUM_THREADS=ALL_CPUS, so default to
+    half the cores; override with FIX_TIFF_WORKERS. Raises ValueError if
+    FIX_TIFF_WORKERS is not an integer of at least 1.
+    """
+    value = os.environ.get('FIX_TIFF_WORKERS')
+    if value is None:
+        return max(1, (os.cpu_count() or 2) // 2)
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        raise ValueError(f"FIX_TIFF_WORKERS must be an integer >= 1, got {value!r}")
+    return workers
+
+def process_directory(directory, pattern="*.tif", compression='ZSTD', verify=False,
+                      max_workers=None):
     """Process all TIFF files in a directory."""
-    import glob
+    # Each file is independent, so fan out across processes (GDAL is not safe
+    # to share between threads)
+    if max_workers is None:
+        max_workers = get_worker_count()
+    # Split the block cache budget so the pool as a whole stays within it
+    worker_cache_mb = max(1, GDAL_CACHE_MB // max_workers)
     
-    tiff_files = glob.glob(os.path.join(directory, pattern))
-    print(f"Found {len(tiff_files)} TIFF files to process")
+    # List the directory fully before any worker writes *_fixed outputs into
+    # it, so new files can never be picked up and reprocessed
+    tiff_files = list(iter_tiff_files(directory, pattern))
     
     success_count = 0
-    for tiff_file in tiff_files:
-        if fix_tiff_predictor(tiff_file, compression=compression):
-            success_count += 1
-        print("-" * 50)
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=configure_gdal,
+        initargs=(worker_cache_mb,)
+    ) as executor:
+        futures = {
+            executor.submit(
+                fix_tiff_predictor, tiff_file, compression=compression,
+                verify=verify, progress=False
+            ): tiff_file
+            for tiff_file in tiff_files
+        }
+        total = len(tiff_files)
+        print(f"Found {total} TIFF files to process")
+        for done, future in enumerate(as_completed(futures), start=1):
+            tiff_file = futures[future]
+            try:
+                ok = future.result()
+            except Exception as e:
+                print(f"[{done}/{total}] {tiff_file}: failed ({e})")
+                continue
+            if ok:
+                success_count += 1
+            print(f"[{done}/{total}] {tiff_file}: {'ok' if ok else 'failed'}")
     
     print(f"\nProcessed {success_count}/{len(tiff_files)} files successfully")
 
@@ -118,8 +232,10 @@ def main():
     parser.add_argument(
         '-c', '--compression',
         choices=['NONE', 'LZW', 'DEFLATE', 'ZSTD'],
-        default='DEFLATE',
-        help='Compression type for output (default: DEFLATE)'
+        default='ZSTD',
+        help='Compression type for output (default: ZSTD). ZSTD reads and writes '
+             'faster than DEFLATE and compresses floating-point rasters better; '
+             'use DEFLATE for readers built without ZSTD support'
     )
     parser.add_argument(
         '-d', '--directory',
@@ -129,26 +245,39 @@ def main():
     parser.add_argument(
         '-p', '--pattern',
         default='*.tif',
-        help='File pattern for directory mode (default: *.tif)'
+        help='File name pattern for directory mode (default: *.tif). Patterns '
+             'with a directory part, such as 2020*/*.tif, are not supported'
+    )
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help='Decode the first block of each output to check it is readable'
     )
     
     args = parser.parse_args()
     
     # Configure GDAL
-    gdal.UseExceptions()
-    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'TRUE')
-    gdal.SetConfigOption('GDAL_NUM_THREADS', 'ALL_CPUS')
+    configure_gdal()
     
     if args.directory:
         if not os.path.isdir(args.input):
             print(f"Error: {args.input} is not a directory")
             sys.exit(1)
-        process_directory(args.input, args.pattern, args.compression)
+        if is_path_pattern(args.pattern):
+            print(f"Error: pattern {args.pattern} must not contain a directory part")
+            sys.exit(1)
+        try:
+            max_workers = get_worker_count()
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        process_directory(args.input, args.pattern, args.compression, args.verify,
+                          max_workers)
     else:
         if not os.path.isfile(args.input):
             print(f"Error: {args.input} is not a file")
             sys.exit(1)
-        success = fix_tiff_predictor(args.input, args.output, args.compression)
+        success = fix_tiff_predictor(args.input, args.output, args.compression, args.verify)
         sys.exit(0 if success else 1)
 
 if __name__ == "__main__":
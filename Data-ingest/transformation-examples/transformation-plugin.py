@@ -4,16 +4,26 @@ This plugin demonstrates how to create a reusable transformation function
 for automated data ingestion pipelines.
 """
 
+import os
 import re
-from typing import Dict
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterable, Iterator, List, Tuple
+import numpy as np
+import rasterio.shutil
 import xarray
 from s3fs import S3File
 from xarray import DataArray
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional; 2D longitudes fall back to NumPy
+    njit = None
+
 
 def ecco_darwin_transformation(
     file_obj: S3File, name: str, nodata: int
-) -> Dict[str, DataArray]:
+) -> Iterator[Tuple[str, DataArray]]:
     """
     Transformation function for the ECCO Darwin dataset
     
@@ -21,79 +31,151 @@ def ecco_darwin_transformation(
     into Cloud Optimized GeoTIFFs (COGs) suitable for ingestion into
     the GHG Center STAC catalog.
     
+    The file is read with the h5netcdf engine (requires the ``h5netcdf``
+    package), which fetches only the HDF5 chunks each variable touches
+    instead of pulling the whole object from S3 before parsing.
+    
     Args:
-        file_obj (s3fs object): S3 file object for one file of the dataset
+        file_obj (s3fs object): S3 file object for one file of the dataset,
+            ideally opened with ``cache_type="readahead"``
         name (str): Name of the file to be transformed
         nodata (int): NoData value as specified by the data provider
     
-    Returns:
-        dict: Dictionary with COG filename as key and data array as value
-              Each entry will be written as a separate COG file
+    Yields:
+        tuple: COG filename and data array, one per variable. Each entry
+               should be written as a separate COG file; yielding lets a
+               variable's Dask graph be released once it has been written
     
     Example:
         >>> from s3fs import S3FileSystem
         >>> fs = S3FileSystem()
-        >>> file_obj = fs.open('s3://bucket/path/to/file.nc')
-        >>> result = ecco_darwin_transformation(file_obj, 'file.nc', -9999)
-        >>> for cog_name, data in result.items():
-        ...     data.rio.to_raster(f"output/{cog_name}")
+        >>> file_obj = fs.open(
+        ...     's3://bucket/path/to/file.nc',
+        ...     cache_type='readahead', block_size=8 * 2**20
+        ... )
+        >>> cogs = ecco_darwin_transformation(file_obj, 'file.nc', -9999)
+        >>> for cog_name, data in cogs:
+        ...     data.rio.to_raster(
+        ...         f"output/{cog_name}", tiled=True, blockxsize=512,
+        ...         blockysize=512, compress="zstd", lock=True
+        ...     )
     """
-    var_data_netcdf = {}
-    
-    # Open the NetCDF dataset
-    xds = xarray.open_dataset(file_obj)
+    # Open the NetCDF dataset lazily with Dask, using 512x512 spatial chunks
+    # that line up with the COG blocks so writes stream tile by tile
+    xds = xarray.open_dataset(
+        file_obj, engine="h5netcdf", chunks={"y": 512, "x": 512}
+    )
     
     # Rename dimensions to standard names
     xds = xds.rename({"y": "latitude", "x": "longitude"})
     
     # Transform coordinates from grid indices to lat/lon
     # Original data uses grid indices (0-1440 for lon, 0-721 for lat)
-    # Convert to standard geographic coordinates
-    xds = xds.assign_coords(
-        longitude=((xds.longitude / 1440) * 360) - 180
-    ).sortby("longitude")
+    # Convert to standard geographic coordinates. The mapping is a positive
+    # linear scale, so ascending grid indices stay sorted and no sortby is needed
+    lon = np.multiply(xds.longitude.values, 360.0 / 1440.0, dtype=np.float64)
+    lon -= 180.0
+    lat = np.multiply(xds.latitude.values, 180.0 / 721.0, dtype=np.float64)
+    lat -= 90.0
+    xds = xds.assign_coords(longitude=lon, latitude=lat)
     
-    xds = xds.assign_coords(
-        latitude=((xds.latitude / 721) * 180) - 90
-    ).sortby("latitude")
+    # Only gridded variables can become COGs; this skips bounds and other
+    # auxiliary variables without relying on their position in the file
+    variables = [
+        var for var in xds.data_vars
+        if {"latitude", "longitude"} <= set(xds[var].dims)
+    ]
     
-    # Get list of data variables (skip first 2 which are usually dimension vars)
-    variables = list(xds.data_vars)[2:]
+    # Extract filename components for creating output names
+    filename = name.split("/")[-1]
+    filename_elements = re.split("[_ .]", filename)
+    # Remove extension
+    filename_elements.pop()
+    # Combine date elements
+    date = filename_elements.pop(-2) + filename_elements.pop(-1)
+    prefix = "_".join(filename_elements)
     
     # Process each variable
     for var in variables:
-        # Extract filename components for creating output name
-        filename = name.split("/")[-1]
-        filename_elements = re.split("[_ .]", filename)
-        
         # Get the data array for this variable
         data = xds[var]
         
-        # Reindex latitude to ensure correct orientation
-        data = data.reindex(latitude=list(reversed(data.latitude)))
+        # Flip latitude so rows run north to south (a strided view, no copy)
+        data = data.isel(latitude=slice(None, None, -1))
         
-        # Replace nodata values with -9999 (standard for COGs)
-        data = data.where(data != nodata, -9999)
+        # Replace nodata values with -9999 (standard for COGs); skip the
+        # full-array mask when the source already uses that sentinel
+        if nodata != -9999:
+            data = data.where(data != nodata, -9999)
         
         # Set spatial dimensions and CRS for rasterio
         data.rio.set_spatial_dims("longitude", "latitude", inplace=True)
         data.rio.write_crs("epsg:4326", inplace=True)
         data.rio.write_nodata(-9999, inplace=True)
         
-        # Create output filename
-        # Remove extension
-        filename_elements.pop()
-        # Combine date elements
-        filename_elements[-1] = filename_elements[-2] + filename_elements[-1]
-        filename_elements.pop(-2)
-        # Create final filename
-        cog_filename = "_".join(filename_elements)
-        cog_filename = f"{cog_filename}.tif"
+        # Create output filename, following {collection}_{variable}_{date}.tif
+        # so that each variable gets its own COG instead of overwriting the last
+        cog_filename = f"{prefix}_{var}_{date}.tif"
         
-        # Add to output dictionary
-        var_data_netcdf[cog_filename] = data
+        yield cog_filename, data
+
+
+def write_cogs(
+    cogs: Iterable[Tuple[str, DataArray]],
+    output_dir: str,
+    max_workers: int = 2
+) -> List[str]:
+    """
+    Write transformed data arrays as COGs in parallel threads
+    
+    rasterio releases the GIL inside libtiff, so writes for different
+    variables run concurrently. The COG driver cannot be written chunk by
+    chunk, so each array is first streamed into a tiled GTiff (with its
+    own lock, so rioxarray writes one Dask chunk at a time) and then
+    converted to a COG with overviews. At most max_workers items are
+    taken from cogs at a time so a generator keeps only those variables
+    alive.
+    
+    Args:
+        cogs: (COG filename, data array) pairs, e.g. from
+              ecco_darwin_transformation
+        output_dir: Directory to write the COG files into
+        max_workers: Number of writer threads; each write already
+                     compresses on all CPUs, so keep this small
     
-    return var_data_netcdf
+    Returns:
+        List of written COG paths, in completion order
+    """
+    def write_cog(cog_filename, data):
+        path = os.path.join(output_dir, cog_filename)
+        tmp_path = f"{path}.tmp.tif"
+        try:
+            data.rio.to_raster(
+                tmp_path, driver="GTiff", tiled=True, blockxsize=512,
+                blockysize=512, BIGTIFF="IF_SAFER", lock=threading.Lock()
+            )
+            rasterio.shutil.copy(
+                tmp_path, path, driver="COG", compress="ZSTD",
+                blocksize=512, num_threads="ALL_CPUS"
+            )
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+    
+    paths = []
+    pending = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for cog_filename, data in cogs:
+            if len(pending) >= max_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                paths.extend(future.result() for future in done)
+            pending.add(executor.submit(write_cog, cog_filename, data))
+            del data
+        done, _ = wait(pending)
+        paths.extend(future.result() for future in done)
+    
+    return paths
 
 
 def create_transformation_plugin(dataset_config: dict):
@@ -138,16 +220,42 @@ def create_transformation_plugin(dataset_config: dict):
 
 # Additional utility functions for common transformation tasks
 
+if njit is not None:
+    # cache=True keeps the compiled kernel on disk for new worker processes;
+    # fastmath is limited to flags that keep NaN fill values intact
+    @njit(parallel=True, cache=True, fastmath={"contract", "arcp"})
+    def _wrap_longitude_2d(lon):
+        out = np.empty(lon.shape, dtype=np.float64)
+        for i in prange(lon.shape[0]):
+            for j in range(lon.shape[1]):
+                v = lon[i, j] + 180.0
+                v -= 360.0 * np.floor(v / 360.0)
+                out[i, j] = v - 180.0
+        return out
+else:
+    def _wrap_longitude_2d(lon):
+        return ((lon.astype(np.float64) + 180) % 360) - 180
+
+
 def fix_longitude_wrap(data: xarray.Dataset) -> xarray.Dataset:
     """
     Fix longitude coordinates from 0-360 to -180-180 convention
     
+    Per-pixel 2D longitude coordinates are wrapped with a fused Numba
+    kernel when numba is installed; they are not re-sorted.
+    
     Args:
         data: xarray Dataset with longitude coordinates
     
     Returns:
         Dataset with corrected longitude coordinates
     """
+    for lon_name in ("longitude", "lon"):
+        if lon_name in data.coords and data[lon_name].ndim == 2:
+            lon = data[lon_name]
+            wrapped = _wrap_longitude_2d(np.ascontiguousarray(lon.values))
+            return data.assign_coords({lon_name: (lon.dims, wrapped, lon.attrs)})
+    
     if "longitude" in data.dims:
         data = data.assign_coords(
             longitude=(((data.longitude + 180) % 360) - 180)
@@ -163,7 +271,8 @@ def fix_longitude_wrap(data: xarray.Dataset) -> xarray.Dataset:
 def apply_scale_and_offset(
     data: DataArray,
     scale_factor: float = 1.0,
-    add_offset: float = 0.0
+    add_offset: float = 0.0,
+    inplace: bool = False
 ) -> DataArray:
     """
     Apply scale factor and offset to data values
@@ -172,44 +281,75 @@ def apply_scale_and_offset(
         data: Input data array
         scale_factor: Multiplicative scale factor
         add_offset: Additive offset
+        inplace: Overwrite the values of a writeable NumPy-backed array
+                 instead of allocating new arrays. This also changes any
+                 object sharing the buffer (e.g. the parent Dataset). Only
+                 used when the result keeps the input dtype.
     
     Returns:
         Scaled and offset data array
     """
+    values = data.data
+    if (
+        inplace
+        and isinstance(values, np.ndarray)
+        and values.flags.writeable
+        and np.result_type(values, scale_factor, add_offset) == values.dtype
+    ):
+        np.multiply(values, scale_factor, out=values)
+        np.add(values, add_offset, out=values)
+        return data
+    
     return data * scale_factor + add_offset
 
 
-def create_cog_profile(data_type: str) -> dict:
+def create_cog_profile(data_type: str, compress: str = "DEFLATE") -> dict:
     """
     Create appropriate COG profile based on data type
     
+    Predictors are only applied with codecs that benefit from them. float64
+    keeps no predictor, since predictors on 64-bit samples are what
+    fix_tiff_predictor.py exists to repair.
+    
     Args:
         data_type: numpy dtype string (e.g., 'float32', 'int16')
+        compress: Compression codec (e.g., 'DEFLATE', 'ZSTD', 'LZW')
     
     Returns:
         Dictionary with COG creation parameters
     """
     base_profile = {
         "driver": "COG",
-        "compress": "DEFLATE",
+        "compress": compress,
         "TILED": True,
         "BLOCKXSIZE": 512,
         "BLOCKYSIZE": 512
     }
+    use_predictor = compress.upper() in ("DEFLATE", "ZSTD", "LZW")
     
     # Special handling for float data types
-    if data_type in ['float32', 'float64']:
+    if data_type == 'float32':
+        base_profile.update({
+            # Floating-point predictor for smooth float rasters
+            "PREDICTOR": 3 if use_predictor else 1,
+            "BIGTIFF": "YES"
+        })
+    elif data_type == 'float64':
         base_profile.update({
-            "PREDICTOR": 1,  # No predictor for float data
-            "ZLEVEL": 6,
+            "PREDICTOR": 1,  # No predictor for 64-bit float data
             "BIGTIFF": "YES"
         })
     elif data_type in ['int16', 'int32']:
         base_profile.update({
-            "PREDICTOR": 2,  # Horizontal differencing for integers
-            "ZLEVEL": 6
+            # Horizontal differencing for integers
+            "PREDICTOR": 2 if use_predictor else 1
         })
     
+    # The COG driver takes the codec level as LEVEL (ZLEVEL is GTiff-only)
+    level = {"DEFLATE": 6, "ZSTD": 9}.get(compress.upper())
+    if level is not None:
+        base_profile["LEVEL"] = level
+    
     return base_profile
 
 